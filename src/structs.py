@@ -15,27 +15,10 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from typing import Optional, Final, Any, Callable
+from typing import Optional, TypedDict
 
 
-class Mapper(dict):
-    NAME_KEY: Final[str] = 'name'
-    ID64_KEY: Final[str] = 'id64'
-
-    def __init__(self, name: Optional[Any], id64: Optional[Any]) -> None:
-        super().__init__()
-
-        self[Mapper.NAME_KEY] = self.__fix_val(name, str)
-        self[Mapper.ID64_KEY] = self.__fix_val(id64, int)
-
-    @property
-    def name(self) -> Optional[str]:
-        return self[Mapper.NAME_KEY]
-
-    @property
-    def id64(self) -> Optional[int]:
-        return self[Mapper.ID64_KEY]
-
-    @staticmethod
-    def __fix_val(s: Optional[Any], type: Callable[[Any], Any]) -> Optional[Any]:
-        return type(s) if s and s != 'null' else None
+# Mappers are only ever serialized, so they're stored as plain dicts.
+class Mapper(TypedDict):
+    name: Optional[str]
+    id64: Optional[int]
@@ -18,26 +18,42 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
-import requests
 import json
-
-from typing import Any, Optional, Final
-from requests import Response
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from argparse import ArgumentParser, BooleanOptionalAction, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import zip_longest
+from hashlib import blake2b
+from typing import Any, Optional, Final, Iterator, Iterable, BinaryIO, Callable
+from requests import Response, Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from structs import Mapper
 
 
-_OPEN_FILE_WRITE_FLAG: Final[str] = 'w'
 _OPEN_FILE_READ_FLAG: Final[str] = 'r'
-
-_STRING_ENCODE_ERROR_STRICT: Final[str] = 'strict'
-_STRING_ENCODE_ERROR_REPLACE: Final[str] = 'replace'
-_STRING_ENCODE_ERROR_IGNORE: Final[str] = 'ignore'
+_OPEN_FILE_WRITE_BINARY_FLAG: Final[str] = 'wb'
+_OPEN_FILE_READ_BINARY_FLAG: Final[str] = 'rb'
 
 _CURRENT_PATH: Final[str] = os.path.dirname(__file__)
 _PARENT_PATH: Final[str] = os.path.join(_CURRENT_PATH, '..')
 
 _BASE_URL: Final[str] = 'https://raw.githubusercontent.com/zer0k-z/kz-map-info/master/'
 
+_REQUEST_TIMEOUT: Final[int] = 30
+_REQUEST_RETRIES: Final[int] = 3
+_REQUEST_RETRY_BACKOFF: Final[float] = 0.5
+_REQUEST_RETRY_STATUSES: Final[tuple[int, ...]] = (429, 500, 502, 503, 504)
+_REQUEST_POOL_CONNECTIONS: Final[int] = 4
+_REQUEST_POOL_MAXSIZE: Final[int] = 8
+
 _FILE_NAMES: Final[dict[str, str]] = {
     'MapsWithMappers': 'maps',
     'MapsWithMappers_Global': 'global',
@@ -50,38 +66,88 @@ _NAME_KEY: Final[str] = 'name'
 _MAPPER_NAME_KEY: Final[str] = 'mapper_name'
 _MAPPER_ID64_KEY: Final[str] = 'mapper_steamid64'
 _MAPPERS_KEY: Final[str] = 'mappers'
+_MAPPER_NAME_OUT_KEY: Final[str] = 'name'
+_MAPPER_ID64_OUT_KEY: Final[str] = 'id64'
 _STR_SEPARATOR: Final[str] = ', '
 
-_URL_KEYS: Final[tuple[str, ...]] = ('workshop_url',)
-_INT_KEYS: Final[tuple[str, ...]] = ('id', 'difficulty')
+_WORKSHOP_URL_KEY: Final[str] = 'workshop_url'
+# noinspection HttpUrlsUsage
+_HTTP_URL_SCHEME: Final[str] = 'http://'
+_HTTPS_URL_SCHEME: Final[str] = 'https://'
+_DIFFICULTY_KEY: Final[str] = 'difficulty'
 
 _JSON_INDENT: Final[int] = 4
 _JSON_SEPARATORS: Final[tuple[str, str]] = (',', ':')
 _JSON_ENSURE_ASCII: Final[bool] = False
-
-_ESCAPE_ENCODING: Final[str] = 'unicode-escape'
-_ESCAPE_ENCODING_ERROR: Final[str] = _STRING_ENCODE_ERROR_REPLACE
+_JSON_LIST_INDENT: Final[bytes] = b' ' * _JSON_INDENT
 
 _DUMP_JSON_FILE_EXT: Final[str] = '.json'
 _DUMP_JSON_FILE_MIN_EXT: Final[str] = f'.min{_DUMP_JSON_FILE_EXT}'
 _DUMP_JSON_FILE_ENCODING: Final[str] = 'utf-8'
+_DUMP_TMP_FILE_EXT: Final[str] = '.tmp'
+_DUMP_LIST_BUFFER_SIZE: Final[int] = 1 << 20
+_DUMP_HASH_SIZE: Final[int] = 16
+_DUMP_HASHES_PATH: Final[str] = os.path.join(_PARENT_PATH, '.hashes')
+_DUMP_MAX_WORKERS: Final[int] = 16
+_FETCH_MAX_WORKERS: Final[int] = len(_FILE_NAMES)
+
+
+def _create_session() -> Session:
+    retry: Final[Retry] = Retry(
+        total=_REQUEST_RETRIES,
+        backoff_factor=_REQUEST_RETRY_BACKOFF,
+        status_forcelist=_REQUEST_RETRY_STATUSES
+    )
+
+    adapter: Final[HTTPAdapter] = HTTPAdapter(
+        pool_connections=_REQUEST_POOL_CONNECTIONS,
+        pool_maxsize=_REQUEST_POOL_MAXSIZE,
+        max_retries=retry
+    )
 
+    session: Final[Session] = Session()
+    session.mount('https://', adapter)
 
-def _unescape(s: Optional[str]) -> Optional[str]:
+    return session
+
+
+_SESSION: Final[Session] = _create_session()
+
+# Dump path -> [content hash, size, mtime], as of the last write.
+_DUMP_HASHES: Final[dict[str, list[Any]]] = {}
+
+
+def _json_loads(s: Optional[bytes]) -> Optional[Any]:
     if not s:
-        return s
+        return None
 
-    # Fix unicode escaped characters.
-    return s.encode(_ESCAPE_ENCODING, errors=_ESCAPE_ENCODING_ERROR) \
-        .replace(b'\\\\u', b'\\u') \
-        .decode(_ESCAPE_ENCODING, errors=_ESCAPE_ENCODING_ERROR)
+    if orjson is not None:
+        return orjson.loads(s)
+
+    return json.loads(s)
+
+
+def _json_dumps(json_object: Optional[Any], is_minified: bool = False) -> Optional[bytes]:
+    if json_object is None:
+        return None
+
+    if not is_minified:
+        # orjson only supports a two-space indent.
+        return json.dumps(json_object, ensure_ascii=_JSON_ENSURE_ASCII, indent=_JSON_INDENT) \
+            .encode(_DUMP_JSON_FILE_ENCODING)
+
+    if orjson is not None:
+        return orjson.dumps(json_object)
+
+    return json.dumps(json_object, ensure_ascii=_JSON_ENSURE_ASCII, separators=_JSON_SEPARATORS) \
+        .encode(_DUMP_JSON_FILE_ENCODING)
 
 
 def _get_url_response(url: Optional[str]) -> Optional[Response]:
     if not url:
         return None
 
-    response: Final[Response] = requests.get(url)
+    response: Final[Response] = _SESSION.get(url, timeout=_REQUEST_TIMEOUT)
     response.raise_for_status()
 
     if response.status_code == 204:
@@ -95,7 +161,7 @@ def _get_url_json(url: Optional[str]) -> Optional[Any]:
     if response is None:
         return None
 
-    return response.json()
+    return _json_loads(response.content)
 
 
 def _str_to_list(val: Optional[str], sep: Optional[str] = None) -> Optional[list[str]]:
@@ -105,69 +171,44 @@ def _str_to_list(val: Optional[str], sep: Optional[str] = None) -> Optional[list
     return val.split(sep)
 
 
-def _norm_list(values: Optional[list[Any]], size: Optional[int]) -> None:
-    if values is None \
-            or size is None \
-            or size < 0:
-        return
-
-    length: Final[int] = len(values)
+def _fix_val(s: Optional[Any], val_type: Callable[[Any], Any]) -> Optional[Any]:
+    if not s or s == 'null':
+        return None
 
-    if length > size:
-        del values[size:]
-    else:
-        values.extend([None] * (size - length))
+    # Skip the conversion when the value already has the wanted type.
+    return s if type(s) is val_type else val_type(s)
 
 
-def _fix_mappers(map_json: Optional[dict[str, Any]]) -> None:
+def _fix_map(map_json: Optional[dict[str, Any]]) -> None:
     if not map_json:
         return
 
-    mapper_names: list[str] = []
-    mapper_id64s: list[str] = []
-
-    if _MAPPER_NAME_KEY in map_json:
-        mapper_names = _str_to_list(map_json[_MAPPER_NAME_KEY], _STR_SEPARATOR)
-        del map_json[_MAPPER_NAME_KEY]
-
-    if _MAPPER_ID64_KEY in map_json:
-        mapper_id64s = _str_to_list(map_json[_MAPPER_ID64_KEY], _STR_SEPARATOR)
-        del map_json[_MAPPER_ID64_KEY]
+    # Mappers
+    mapper_names: Final[list[str]] = _str_to_list(map_json.pop(_MAPPER_NAME_KEY, None), _STR_SEPARATOR) or []
+    mapper_id64s: Final[list[str]] = _str_to_list(map_json.pop(_MAPPER_ID64_KEY, None), _STR_SEPARATOR) or []
 
-    length: Final[int] = max(len(mapper_names), len(mapper_id64s))
-
-    _norm_list(mapper_names, length)
-    _norm_list(mapper_id64s, length)
-
-    mappers: Final[list[Optional[Mapper]]] = []
-
-    for i in range(length):
-        mappers.append(Mapper(mapper_names[i], mapper_id64s[i]))
+    mappers: Final[list[Mapper]] = [
+        {_MAPPER_NAME_OUT_KEY: _fix_val(name, str), _MAPPER_ID64_OUT_KEY: _fix_val(id64, int)}
+        for name, id64 in zip_longest(mapper_names, mapper_id64s)
+    ]
 
     map_json[_MAPPERS_KEY] = mappers
 
-
-def _fix_urls(map_json: Optional[dict[str, Any]]) -> None:
-    if not map_json:
-        return
-
-    for key in _URL_KEYS:
-        url: str = map_json[key]
-        # noinspection HttpUrlsUsage
-        map_json[key] = url.replace('http://', 'https://', 1) \
+    # URLs
+    url: Optional[str] = map_json.get(_WORKSHOP_URL_KEY)
+    if url:
+        # Not a prefix check; some upstream URLs carry leading whitespace.
+        map_json[_WORKSHOP_URL_KEY] = url.replace(_HTTP_URL_SCHEME, _HTTPS_URL_SCHEME, 1) \
             .replace('/?', '?', 1)
 
+    # Types
+    map_id: Optional[Any] = map_json.get(_ID_KEY)
+    if map_id:
+        map_json[_ID_KEY] = int(map_id)
 
-def _fix_types(map_json: Optional[dict[str, Any]]) -> None:
-    if not map_json:
-        return
-
-    for key in _INT_KEYS:
-        val: Optional[Any] = map_json.get(key)
-        if not val:
-            continue
-
-        map_json[key] = int(val)
+    difficulty: Optional[Any] = map_json.get(_DIFFICULTY_KEY)
+    if difficulty:
+        map_json[_DIFFICULTY_KEY] = int(difficulty)
 
 
 def _fix_maps(maps_json: Optional[list[dict[str, Any]]]) -> None:
@@ -175,25 +216,37 @@ def _fix_maps(maps_json: Optional[list[dict[str, Any]]]) -> None:
         return None
 
     for map_json in maps_json:
-        _fix_mappers(map_json)
-        _fix_urls(map_json)
-        _fix_types(map_json)
+        _fix_map(map_json)
 
 
-def _dump_json(
-    file_path: Optional[str],
-    file_name: Optional[str],
-    json_object: Optional[Any]
-) -> bool:
-    if file_path is None \
-            or not json_object:
-        return False
+@contextmanager
+def _open_atomic(file_path: str, buffering: int = -1) -> Iterator[BinaryIO]:
+    # Write next to the target and swap it in, so an interrupted run never
+    # leaves a half-written dump behind. The temp name is unique per process
+    # and thread, so concurrent writers never share one.
+    tmp_path: Final[str] = f'{file_path}.{os.getpid()}.{threading.get_ident()}{_DUMP_TMP_FILE_EXT}'
+
+    try:
+        with open(tmp_path, _OPEN_FILE_WRITE_BINARY_FLAG, buffering=buffering) as file:
+            yield file
+
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        raise
+
+
+def _get_dump_path(file_path: Optional[str], file_name: Optional[str]) -> Optional[str]:
+    if file_path is None:
+        return None
 
     file_path = os.path.normpath(file_path)
 
     if not file_name:
         if not file_path:
-            return False
+            return None
 
         file_base_name: Final[str] = os.path.basename(file_path)
         file_split_ext: Final[tuple[str, str]] = os.path.splitext(file_base_name)
@@ -201,47 +254,216 @@ def _dump_json(
         file_path = os.path.dirname(file_path)
         file_name = file_split_ext[0]
 
-    if file_path \
-            and not os.path.exists(file_path):
-        os.makedirs(file_path)
+    if file_path:
+        os.makedirs(file_path, exist_ok=True)
 
-    dump_path: Final[str] = os.path.join(file_path, file_name)
+    return os.path.join(file_path, file_name)
 
-    with open(dump_path + _DUMP_JSON_FILE_EXT, _OPEN_FILE_WRITE_FLAG, encoding=_DUMP_JSON_FILE_ENCODING) as file:
-        file.write(_unescape(json.dumps(json_object, ensure_ascii=_JSON_ENSURE_ASCII, indent=_JSON_INDENT)))
 
-    with open(dump_path + _DUMP_JSON_FILE_MIN_EXT, _OPEN_FILE_WRITE_FLAG, encoding=_DUMP_JSON_FILE_ENCODING) as file:
-        file.write(_unescape(json.dumps(json_object, ensure_ascii=_JSON_ENSURE_ASCII, separators=_JSON_SEPARATORS)))
+def _load_dump_hashes() -> None:
+    _DUMP_HASHES.clear()
+
+    try:
+        with open(_DUMP_HASHES_PATH, _OPEN_FILE_READ_BINARY_FLAG) as file:
+            dump_hashes: Optional[Any] = _json_loads(file.read())
+    except (OSError, ValueError):
+        return
+
+    if isinstance(dump_hashes, dict):
+        _DUMP_HASHES.update(dump_hashes)
+
+
+def _save_dump_hashes() -> None:
+    if not _DUMP_HASHES:
+        return
+
+    with _open_atomic(_DUMP_HASHES_PATH) as file:
+        file.write(_json_dumps(_DUMP_HASHES, is_minified=True))
+
+
+def _dump_file(
+    file_path: str,
+    get_chunks: Callable[[], Iterable[bytes]],
+    buffering: int = -1
+) -> None:
+    hasher: Final[Any] = blake2b(digest_size=_DUMP_HASH_SIZE)
+    for chunk in get_chunks():
+        hasher.update(chunk)
+
+    digest: Final[str] = hasher.hexdigest()
+    hash_key: Final[str] = os.path.relpath(file_path, _PARENT_PATH)
+
+    # Skip the write when the content is unchanged and the file on disk is
+    # still the one written last time.
+    entry: Final[Optional[list[Any]]] = _DUMP_HASHES.get(hash_key)
+    if entry is not None \
+            and entry[0] == digest:
+        try:
+            old_stat: Final[os.stat_result] = os.stat(file_path)
+            if entry[1:] == [old_stat.st_size, old_stat.st_mtime_ns]:
+                return
+        except OSError:
+            pass
+
+    with _open_atomic(file_path, buffering) as file:
+        for chunk in get_chunks():
+            file.write(chunk)
+
+    stat: Final[os.stat_result] = os.stat(file_path)
+    _DUMP_HASHES[hash_key] = [digest, stat.st_size, stat.st_mtime_ns]
+
+
+def _iter_json_list_bytes(items_bytes: list[bytes], is_minified: bool = False) -> Iterator[bytes]:
+    # Stream the already serialized items instead of building the whole list
+    # in memory, nesting each pretty item one indent level deeper.
+    if is_minified:
+        yield b'['
+
+        for i, item_min_bytes in enumerate(items_bytes):
+            if i:
+                yield b','
+
+            yield item_min_bytes
+
+        yield b']'
+        return
+
+    yield b'[\n'
+
+    for i, item_bytes in enumerate(items_bytes):
+        if i:
+            yield b',\n'
+
+        yield _JSON_LIST_INDENT
+        yield item_bytes.replace(b'\n', b'\n' + _JSON_LIST_INDENT)
+
+    yield b'\n]'
+
+
+def _write_json_bytes(
+    dump_path: str,
+    json_bytes: Optional[bytes],
+    json_min_bytes: Optional[bytes]
+) -> bool:
+    # The caller resolves the path and creates its directory up front.
+    if not json_bytes \
+            or not json_min_bytes:
+        return False
+
+    _dump_file(dump_path + _DUMP_JSON_FILE_EXT, lambda: (json_bytes,))
+    _dump_file(dump_path + _DUMP_JSON_FILE_MIN_EXT, lambda: (json_min_bytes,))
 
     return True
 
 
-def _main() -> None:
-    for fkey, fname in _FILE_NAMES.items():
-        maps_json: Optional[Any] = _get_url_json(_BASE_URL + fkey + _DUMP_JSON_FILE_EXT)
-        if not maps_json:
-            return
+def _dump_json_list_bytes(
+    file_path: Optional[str],
+    file_name: Optional[str],
+    items_bytes: Optional[list[bytes]],
+    items_min_bytes: Optional[list[bytes]]
+) -> bool:
+    if not items_bytes \
+            or not items_min_bytes:
+        return False
+
+    dump_path: Final[Optional[str]] = _get_dump_path(file_path, file_name)
+    if dump_path is None:
+        return False
 
-        _fix_maps(maps_json)
+    _dump_file(
+        dump_path + _DUMP_JSON_FILE_EXT,
+        lambda: _iter_json_list_bytes(items_bytes),
+        _DUMP_LIST_BUFFER_SIZE
+    )
+    _dump_file(
+        dump_path + _DUMP_JSON_FILE_MIN_EXT,
+        lambda: _iter_json_list_bytes(items_min_bytes, is_minified=True),
+        _DUMP_LIST_BUFFER_SIZE
+    )
 
-        is_success: bool = _dump_json(_PARENT_PATH, fname, maps_json)
-        if not is_success:
-            return
+    return True
 
-        dump_path = os.path.join(_PARENT_PATH, fname)
-        for map_json in maps_json:
-            is_success = _dump_json(dump_path, map_json[_NAME_KEY], map_json)
-            if not is_success:
+
+def _parse_args() -> Namespace:
+    parser: Final[ArgumentParser] = ArgumentParser(description='Update the maps info dumps.')
+    parser.add_argument('--aggregate', action=BooleanOptionalAction, default=True,
+                        help='dump every group as a single file')
+    parser.add_argument('--by-name', action=BooleanOptionalAction, default=True,
+                        help='dump every map by its name')
+    parser.add_argument('--by-id', action=BooleanOptionalAction, default=True,
+                        help='dump every map by its id')
+
+    return parser.parse_args()
+
+
+def _main(is_aggregate: bool = True, is_by_name: bool = True, is_by_id: bool = True) -> None:
+    if not is_aggregate \
+            and not is_by_name \
+            and not is_by_id:
+        return
+
+    # Fetch all source files at once; they're independent of one another.
+    with ThreadPoolExecutor(max_workers=_FETCH_MAX_WORKERS) as executor:
+        files_json: Final[dict[str, Optional[Any]]] = dict(zip(
+            _FILE_NAMES,
+            executor.map(lambda fkey: _get_url_json(_BASE_URL + fkey + _DUMP_JSON_FILE_EXT), _FILE_NAMES)
+        ))
+
+    _load_dump_hashes()
+
+    try:
+        for fkey, fname in _FILE_NAMES.items():
+            maps_json: Optional[Any] = files_json[fkey]
+            if not maps_json:
                 return
 
-        for map_json in maps_json:
-            is_success = _dump_json(dump_path, str(map_json[_ID_KEY]), map_json)
+            _fix_maps(maps_json)
+
+            maps_bytes: Final[list[bytes]] = [_json_dumps(map_json) for map_json in maps_json]
+            maps_min_bytes: Final[list[bytes]] = [_json_dumps(map_json, is_minified=True) for map_json in maps_json]
+
+            is_success: bool = True
+
+            if is_aggregate:
+                is_success = _dump_json_list_bytes(_PARENT_PATH, fname, maps_bytes, maps_min_bytes)
+                if not is_success:
+                    return
+
+            if not is_by_name \
+                    and not is_by_id:
+                continue
+
+            dump_path: Final[str] = os.path.normpath(os.path.join(_PARENT_PATH, fname))
+            os.makedirs(dump_path, exist_ok=True)
+
+            # Keyed by target path, so maps sharing a name or id are written
+            # once. Names are filled in before ids so the last one wins, just
+            # like the sequential by-name then by-id passes.
+            dump_args: Final[dict[str, tuple[bytes, bytes]]] = {}
+            if is_by_name:
+                for i, map_json in enumerate(maps_json):
+                    dump_args[os.path.join(dump_path, map_json[_NAME_KEY])] = (maps_bytes[i], maps_min_bytes[i])
+
+            if is_by_id:
+                for i, map_json in enumerate(maps_json):
+                    dump_args[os.path.join(dump_path, str(map_json[_ID_KEY]))] = (maps_bytes[i], maps_min_bytes[i])
+
+            # Overlap the many small per-map writes.
+            with ThreadPoolExecutor(max_workers=_DUMP_MAX_WORKERS) as executor:
+                is_success = all(executor.map(
+                    lambda item: _write_json_bytes(item[0], *item[1]),
+                    dump_args.items()
+                ))
+
             if not is_success:
                 return
+    finally:
+        _save_dump_hashes()
 
 
 if __name__ == '__main__':
     try:
-        _main()
+        args: Final[Namespace] = _parse_args()
+        _main(args.aggregate, args.by_name, args.by_id)
     except KeyboardInterrupt:
         pass